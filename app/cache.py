@@ -0,0 +1,90 @@
+"""Translation cache keyed by (text, source_lang, target_lang).
+
+An in-process LRU sits in front of an optional SQLite store, which is enabled
+by pointing the TRANSLATION_CACHE_DB environment variable at a database file.
+Lookups and writes may block on SQLite, so async callers run them in a thread.
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from cachetools import LRUCache
+
+CACHE_MAX_ENTRIES = 100_000
+_SQLITE_MAX_PARAMS = 500
+
+_memory = LRUCache(maxsize=CACHE_MAX_ENTRIES)
+_lock = threading.Lock()
+_db: Optional[sqlite3.Connection] = None
+_db_checked = False
+
+
+def _connection() -> Optional[sqlite3.Connection]:
+    """Open the SQLite store on first use, or return None if it is disabled"""
+    global _db, _db_checked
+    if not _db_checked:
+        _db_checked = True
+        path = os.getenv("TRANSLATION_CACHE_DB")
+        if path:
+            _db = sqlite3.connect(path, check_same_thread=False)
+            _db.execute("PRAGMA journal_mode=WAL")
+            _db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "text TEXT, src TEXT, tgt TEXT, out TEXT, "
+                "PRIMARY KEY (text, src, tgt))"
+            )
+            _db.commit()
+    return _db
+
+
+def _key(text: str, src: Optional[str], tgt: str) -> Tuple[str, str, str]:
+    # SQLite treats NULLs as distinct in primary keys, so auto-detect is stored as ""
+    return text, (src or "").upper(), tgt.upper()
+
+
+def get_many(texts: Iterable[str], src: Optional[str], tgt: str) -> Dict[str, str]:
+    """Return the cached translations of texts, omitting misses"""
+    found = {}
+    with _lock:
+        misses = []
+        for text in texts:
+            cached = _memory.get(_key(text, src, tgt))
+            if cached is None:
+                misses.append(text)
+            else:
+                found[text] = cached
+
+        db = _connection()
+        if db is None or not misses:
+            return found
+
+        _, src_key, tgt_key = _key("", src, tgt)
+        # Stay well below SQLite's limit on bound parameters per statement
+        for start in range(0, len(misses), _SQLITE_MAX_PARAMS):
+            chunk = misses[start:start + _SQLITE_MAX_PARAMS]
+            rows = db.execute(
+                "SELECT text, out FROM cache WHERE src = ? AND tgt = ? "
+                f"AND text IN ({', '.join('?' * len(chunk))})",
+                [src_key, tgt_key, *chunk]
+            ).fetchall()
+            for text, out in rows:
+                _memory[(text, src_key, tgt_key)] = out
+                found[text] = out
+        return found
+
+
+def put_many(entries: Iterable[Tuple[str, str]], src: Optional[str], tgt: str) -> None:
+    """Store (text, translation) pairs for one language pair in a single transaction"""
+    rows = [_key(text, src, tgt) + (out,) for text, out in entries]
+    with _lock:
+        for *key, out in rows:
+            _memory[tuple(key)] = out
+
+        db = _connection()
+        if db is None:
+            return
+        db.executemany(
+            "INSERT OR REPLACE INTO cache (text, src, tgt, out) VALUES (?, ?, ?, ?)", rows
+        )
+        db.commit()
@@ -1,99 +1,258 @@
+import asyncio
+import copy
+import io
+import json
 import os
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body
-from typing import Any, Dict, List, Union, Optional
+import re
+import tempfile
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body, Request
+from typing import Any, AsyncIterator, Callable, Dict, List, Tuple, Union, Optional
 from fastapi.params import Query
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+import aiofiles
 import httpx
-from pydantic import BaseModel, Field
+import ijson
+import orjson
+import deepl
+from starlette.background import BackgroundTask
 from dotenv import load_dotenv
 
+from app import cache
+from app.models import TranslateDocumentRequest
+from app.throttle import AsyncTokenBucket
+
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="EU Farmbook Translation Service",
-              description="Standalone FastAPI microservice for the translation of documents and JSON files using DeepL API.")
+DEEPL_API_KEY = os.getenv("DEEPL_API_KEY")
+
+# DeepL accepts at most 50 texts per request and roughly 128 KiB of request body.
+# Batches are packed to a lower budget to leave room for form encoding.
+DEEPL_MAX_BATCH_TEXTS = 50
+DEEPL_MAX_BATCH_BYTES = 100_000
+DEEPL_TEXT_OVERHEAD_BYTES = 16
+DEEPL_MAX_TEXT_BYTES = 120_000
+
+# Free-tier keys (ending in ":fx") are refused JSON that would exceed this many
+# characters in one request, since it would exhaust the monthly quota
+DEEPL_FREE_MAX_CHARS = int(os.getenv("DEEPL_FREE_MAX_CHARS", "500000"))
+
+# Number of batch requests allowed in flight at once. Retrying 429 and 5xx responses
+# with exponential backoff is left to the DeepL client (deepl.http_client.max_network_retries).
+DEEPL_MAX_CONCURRENCY = int(os.getenv("DEEPL_MAX_CONCURRENCY", "10"))
+
+# Client-side limits on DeepL requests and characters per second for this API key,
+# so load is smoothed out before the server answers with 429. Raise these for Pro plans.
+DEEPL_REQUEST_RATE = float(os.getenv("DEEPL_REQUEST_RATE", "10"))
+DEEPL_CHAR_RATE = float(os.getenv("DEEPL_CHAR_RATE", "50000"))
+if DEEPL_REQUEST_RATE <= 0 or DEEPL_CHAR_RATE <= 0:
+    raise RuntimeError("DEEPL_REQUEST_RATE and DEEPL_CHAR_RATE must be positive")
+_request_bucket = AsyncTokenBucket(DEEPL_REQUEST_RATE, DEEPL_REQUEST_RATE)
+_char_bucket = AsyncTokenBucket(DEEPL_CHAR_RATE, DEEPL_CHAR_RATE)
+
+# Chunk size used when streaming documents to and from disk
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Downloads up to this size are translated from memory instead of via temporary files
+IN_MEMORY_DOCUMENT_MAX_BYTES = 10 * 1024 * 1024
+
+# Values that DeepL would return unchanged: URLs, emails, ISO timestamps, numbers and UUIDs
+_SKIP_RE = re.compile(r'^(?:https?://\S+|[A-Za-z0-9._%+-]+@\S+|\d{4}-\d{2}-\d{2}T.*|[+\-]?\.?\d[0-9.eE+\-]*|[0-9a-fA-F-]{36})$')
+
+# Pure Python ijson backend, used when the C backend overflows on a big integer
+_IJSON_PYTHON_BACKEND = ijson.get_backend("python")
+
+# Intermediate documents are transient, so keep them on tmpfs when it is available.
+# DOCUMENT_TMPDIR overrides this, e.g. when /dev/shm is too small for large documents.
+_TMPDIR = (os.getenv("DOCUMENT_TMPDIR")
+           or ("/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)
+               else tempfile.gettempdir()))
+
+
+def _dumps(content: Any) -> bytes:
+    """Serialize with orjson, falling back to the stdlib for values it rejects.
+
+    orjson refuses integers outside the 64-bit range, which are valid JSON.
+    """
+    try:
+        return orjson.dumps(content)
+    except orjson.JSONEncodeError:
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
-class DocumentMetadata(BaseModel):
-    id: str = Field(..., alias="@id")
-    object_name: str
-    object_hash: str
-    object_extension: str
-    object_size: int
+class _OrjsonFallbackResponse(ORJSONResponse):
+    """ORJSONResponse that also renders values orjson rejects, via _dumps"""
 
-    class Config:
-        populate_by_name = True
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
 
 
-class TranslateDocumentRequest(BaseModel):
-    object_metadata: DocumentMetadata
-    target_lang: str
-    source_lang: Optional[str] = None
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one HTTP connection pool and one DeepL client across all requests"""
+    if not DEEPL_API_KEY:
+        raise RuntimeError("DeepL API key not configured")
+
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_keepalive_connections=50),
+    )
+    app.state.deepl = deepl.Translator(DEEPL_API_KEY)
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        app.state.deepl.close()
+
+
+app = FastAPI(title="EU Farmbook Translation Service",
+              description="Standalone FastAPI microservice for the translation of documents and JSON files using DeepL API.",
+              default_response_class=_OrjsonFallbackResponse,
+              lifespan=lifespan)
 
 
 @app.post("/translate-document")
-async def translate_document(request: TranslateDocumentRequest):
-    import tempfile
-    import os
-    import deepl
+async def translate_document(payload: TranslateDocumentRequest, request: Request):
+    temp_dir = None
 
     try:
-        file_url = request.object_metadata.id
+        file_url = payload.object_metadata.id
         if not file_url:
             raise HTTPException(status_code=400, detail="Missing file URL in object metadata")
 
-        file_name = request.object_metadata.object_name
-        file_ext = request.object_metadata.object_extension
+        file_name = payload.object_metadata.object_name
+        file_ext = payload.object_metadata.object_extension
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(file_url)
-            if response.status_code != 200:
-                raise HTTPException(status_code=500,
-                                    detail=f"Failed to download file: HTTP {response.status_code}")
-            contents = response.content
+        deepl_client = request.app.state.deepl
 
-        api_key = os.getenv("DEEPL_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="DeepL API key not configured")
+        headers = {"Content-Disposition": _content_disposition(f"translated_{file_name}")}
 
-        deepl_client = deepl.Translator(api_key)
+        input_buffer, temp_dir = await _download(request.app.state.http, file_url, f"in{file_ext}")
 
-        with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as temp_input:
-            temp_input.write(contents)
-            input_path = temp_input.name
+        # Small documents never touch the filesystem
+        if input_buffer is not None:
+            output_buffer = io.BytesIO()
+            await _request_bucket.acquire()
+            await asyncio.to_thread(
+                deepl_client.translate_document,
+                input_buffer,
+                output_buffer,
+                target_lang=payload.target_lang,
+                source_lang=payload.source_lang,
+                filename=f"in{file_ext}"
+            )
 
-        output_path = tempfile.NamedTemporaryFile(suffix=file_ext, delete=False).name
+            return Response(
+                content=output_buffer.getvalue(),
+                media_type="application/octet-stream",
+                headers=headers
+            )
 
+        input_path = os.path.join(temp_dir.name, f"in{file_ext}")
+        output_path = os.path.join(temp_dir.name, f"out{file_ext}")
 
-        deepl_client.translate_document_from_filepath(
+        await _request_bucket.acquire()
+        await asyncio.to_thread(
+            deepl_client.translate_document_from_filepath,
             input_path,
             output_path,
-            target_lang=request.target_lang,
-            source_lang=request.source_lang
+            target_lang=payload.target_lang,
+            source_lang=payload.source_lang
         )
 
-        with open(output_path, "rb") as output_file:
-            translated_content = output_file.read()
-
-        output_filename = f"translated_{file_name}"
-
-        os.unlink(input_path)
-        os.unlink(output_path)
-
-        return StreamingResponse(
-            content=iter([translated_content]),
+        # FileResponse hands the file to the server, which uses sendfile where supported.
+        # The temporary directory is removed once the response has been sent.
+        return FileResponse(
+            output_path,
             media_type="application/octet-stream",
-            headers={"Content-Disposition": f"attachment; filename={output_filename}"}
+            headers=headers,
+            background=BackgroundTask(temp_dir.cleanup)
         )
 
+    except HTTPException:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+        raise
     except deepl.DeepLException as e:
+        if temp_dir is not None:
+            temp_dir.cleanup()
         raise HTTPException(status_code=500, detail=f"DeepL API error: {str(e)}")
     except Exception as e:
+        if temp_dir is not None:
+            temp_dir.cleanup()
         raise HTTPException(status_code=500, detail=f"Error translating document: {str(e)}")
 
 
+def _content_disposition(filename: str) -> str:
+    """Build an attachment header the way Starlette's FileResponse does"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def _download(
+        client: httpx.AsyncClient,
+        url: str,
+        spill_name: str
+) -> Tuple[Optional[io.BytesIO], Optional[tempfile.TemporaryDirectory]]:
+    """Download url, failing on any non-200 response.
+
+    The body is buffered in memory and returned as (buffer, None) while it stays
+    within IN_MEMORY_DOCUMENT_MAX_BYTES. Larger bodies, judged by Content-Length
+    or by the bytes actually received, are written to spill_name inside a new
+    temporary directory under _TMPDIR, returned as (None, directory).
+    """
+    temp_dir = None
+    spill = None
+
+    async def open_spill():
+        nonlocal temp_dir
+        temp_dir = tempfile.TemporaryDirectory(dir=_TMPDIR)
+        return await aiofiles.open(os.path.join(temp_dir.name, spill_name), "wb")
+
+    try:
+        async with client.stream("GET", url) as response:
+            if response.status_code != 200:
+                raise HTTPException(status_code=500,
+                                    detail=f"Failed to download file: HTTP {response.status_code}")
+
+            buffer = io.BytesIO()
+            try:
+                content_length = response.headers.get("content-length", "")
+                if content_length.isdigit() and int(content_length) > IN_MEMORY_DOCUMENT_MAX_BYTES:
+                    spill = await open_spill()
+
+                async for chunk in response.aiter_bytes(FILE_CHUNK_SIZE):
+                    if spill is None and buffer.tell() + len(chunk) > IN_MEMORY_DOCUMENT_MAX_BYTES:
+                        spill = await open_spill()
+                        await spill.write(buffer.getvalue())
+                        buffer = None
+
+                    if spill is None:
+                        buffer.write(chunk)
+                    else:
+                        await spill.write(chunk)
+            finally:
+                if spill is not None:
+                    await spill.close()
+    except BaseException:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+        raise
+
+    if temp_dir is not None:
+        return None, temp_dir
+    buffer.seek(0)
+    return buffer, None
+
+
 @app.post("/translate-json")
 async def translate_json(
+    request: Request,
     data: dict = Body(..., description="JSON content to translate"),
     target_lang: str = Query(..., description="Target language code"),
     source_lang: str = Query(None, description="Source language code (optional)")
@@ -115,43 +274,120 @@ async def translate_json(
     ```
       /translate-json?target_lang=DE&source_lang=EN
     ```
+
+    The response is newline-delimited JSON: one `{"progress": 0.5}` line per
+    completed batch, then `{"result": {...}}` with the translated content, or
+    `{"error": "..."}` if translation fails part way through.
     """
 
-    import deepl
-    import os
+    try:
+        deepl_client = request.app.state.deepl
+
+        root, progress = await prepare_json_translation(
+            data,
+            deepl_client,
+            target_lang,
+            source_lang
+        )
+
+        return StreamingResponse(
+            content=_ndjson_progress(root, progress),
+            media_type="application/x-ndjson"
+        )
+
+    except HTTPException:
+        raise
+    except deepl.DeepLException as e:
+        raise HTTPException(status_code=500, detail=f"DeepL API error: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error translating JSON: {str(e)}")
+
+
+@app.post("/translate-json-file")
+async def translate_json_file(
+    request: Request,
+    file: UploadFile = File(..., description="JSON file to translate"),
+    target_lang: str = Form(..., description="Target language code"),
+    source_lang: Optional[str] = Form(None, description="Source language code (optional)")
+):
+    """Translate an uploaded JSON file using DeepL API.
+
+    The upload is parsed incrementally from its spooled file rather than read
+    into memory and decoded first. The response has the same format as
+    /translate-json.
+    """
 
     try:
-        api_key = os.getenv("DEEPL_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="DeepL API key not configured")
+        deepl_client = request.app.state.deepl
 
-        deepl_client = deepl.Translator(api_key)
+        data = await asyncio.to_thread(_parse_json_stream, file.file)
 
-        translated_data = await translate_json_values(
+        root, progress = await prepare_json_translation(
             data,
             deepl_client,
             target_lang,
             source_lang
         )
 
-        return translated_data
+        return StreamingResponse(
+            content=_ndjson_progress(root, progress),
+            media_type="application/x-ndjson"
+        )
 
+    except HTTPException:
+        raise
     except deepl.DeepLException as e:
         raise HTTPException(status_code=500, detail=f"DeepL API error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error translating JSON: {str(e)}")
 
 
-@app.get("/deepl-usage")
-async def get_deepl_usage():
-    import deepl
+def _parse_json_stream(stream: Any) -> Any:
+    """Build the JSON document in stream without buffering the raw bytes.
+
+    The default C backend cannot represent integers beyond 64 bits. Only when
+    it fails for that reason is the upload parsed again with the slower pure
+    Python backend, which handles them.
+    """
+    try:
+        return _parse_single_value(ijson, stream)
+    except ijson.JSONError as e:
+        if "integer overflow" not in str(e):
+            raise HTTPException(status_code=400, detail=f"Invalid JSON file: {str(e)}")
+        stream.seek(0)
+
     try:
-        api_key = os.getenv("DEEPL_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="DeepL API key not configured")
+        return _parse_single_value(_IJSON_PYTHON_BACKEND, stream)
+    except ijson.JSONError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON file: {str(e)}")
+
+
+def _parse_single_value(backend: Any, stream: Any) -> Any:
+    # Draining the iterator makes the parser reject anything after the first value
+    [value] = backend.items(stream, "", use_float=True)
+    return value
+
+
+async def _ndjson_progress(root: List[Any], progress: AsyncIterator[float]):
+    """Yield progress lines as batches finish, then the translated JSON"""
+    try:
+        async for fraction in progress:
+            yield _dumps({"progress": fraction}) + b"\n"
+        yield _dumps({"result": root[0]}) + b"\n"
+    except deepl.DeepLException as e:
+        yield _dumps({"error": f"DeepL API error: {str(e)}"}) + b"\n"
+    except Exception as e:
+        yield _dumps({"error": f"Error translating JSON: {str(e)}"}) + b"\n"
+    finally:
+        await progress.aclose()
+
 
-        deepl_client = deepl.Translator(api_key)
-        return deepl_client.get_usage()
+@app.get("/deepl-usage")
+async def get_deepl_usage(request: Request):
+    try:
+        deepl_client = request.app.state.deepl
+        await _request_bucket.acquire()
+        return await asyncio.to_thread(deepl_client.get_usage)
 
     except deepl.DeepLException as e:
         raise HTTPException(status_code=500, detail=f"DeepL API error: {str(e)}")
@@ -159,34 +395,172 @@ async def get_deepl_usage():
         raise HTTPException(status_code=500, detail=f"Error checking DeepL usage: {str(e)}")
 
 
-async def translate_json_values(
-        data: Union[Dict, List, str, int, float, bool, None],
+def _walk(data: Any, visit: Callable[[Any, Any, Any], None]) -> None:
+    """Call visit(parent, key, value) for every leaf in data, in document order.
+
+    Uses an explicit stack rather than recursion so deeply nested JSON costs
+    no Python frames and cannot hit the recursion limit.
+    """
+    stack = [(None, None, data)]
+    while stack:
+        parent, key, value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(reversed([(value, k, item) for k, item in value.items()]))
+        elif isinstance(value, list):
+            stack.extend(reversed([(value, i, item) for i, item in enumerate(value)]))
+        else:
+            visit(parent, key, value)
+
+
+def _is_translatable(text: str) -> bool:
+    """Whether text contains words worth sending to DeepL"""
+    return (len(text.strip()) >= 2
+            and any(c.isalpha() for c in text)
+            and not _SKIP_RE.match(text))
+
+
+def _collect(data: Any, out: List[tuple]) -> None:
+    """Append (parent, key, text) for every translatable string value in data"""
+    def visit(parent: Any, key: Any, value: Any) -> None:
+        if isinstance(value, str) and _is_translatable(value):
+            out.append((parent, key, value))
+
+    _walk(data, visit)
+
+
+def _measure(texts: List[str]) -> List[int]:
+    """Return the encoded size of each text, rejecting input DeepL cannot accept"""
+    sizes = [len(text.encode("utf-8")) for text in texts]
+
+    if sizes and max(sizes) > DEEPL_MAX_TEXT_BYTES:
+        raise HTTPException(status_code=413,
+                            detail=f"JSON contains a string of {max(sizes)} bytes; "
+                                   f"DeepL accepts at most {DEEPL_MAX_TEXT_BYTES} bytes per text")
+
+    total_chars = sum(len(text) for text in texts)
+    if (DEEPL_API_KEY or "").endswith(":fx") and total_chars > DEEPL_FREE_MAX_CHARS:
+        raise HTTPException(status_code=413,
+                            detail=f"JSON requires translating {total_chars} characters, more than the "
+                                   f"{DEEPL_FREE_MAX_CHARS} allowed per request on the DeepL Free plan; "
+                                   f"split the document into smaller parts")
+
+    return sizes
+
+
+def _batches(sizes: List[int]) -> List[List[int]]:
+    """Greedily group text indices into batches that respect DeepL's per-request limits"""
+    batches = []
+    current = []
+    current_size = 0
+    for index, size in enumerate(sizes):
+        size += DEEPL_TEXT_OVERHEAD_BYTES
+        if current and (len(current) == DEEPL_MAX_BATCH_TEXTS or current_size + size > DEEPL_MAX_BATCH_BYTES):
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(index)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _translate_batch(
+        semaphore: asyncio.Semaphore,
         translator: Any,
+        texts: List[str],
         target_lang: str,
         source_lang: str = None
-) -> Union[Dict, List, str, int, float, bool, None]:
-    """Recursively translate values in JSON while preserving keys and structure"""
-
-    # Handle dictionary
-    if isinstance(data, dict):
-        result = {}
-        for key, value in data.items():
-            result[key] = await translate_json_values(value, translator, target_lang, source_lang)
-        return result
-
-    # Handle list
-    elif isinstance(data, list):
-        return [await translate_json_values(item, translator, target_lang, source_lang) for item in data]
-
-    # Translate string values
-    elif isinstance(data, str) and data.strip():
-        translation = translator.translate_text(
-            data,
+) -> List[Any]:
+    """Translate one batch off the event loop, throttled to the configured rates"""
+    chars = sum(len(text) for text in texts)
+    async with semaphore:
+        await _request_bucket.acquire()
+        await _char_bucket.acquire(chars)
+        return await asyncio.to_thread(
+            translator.translate_text,
+            texts,
             target_lang=target_lang,
             source_lang=source_lang,
         )
-        return str(translation)
 
-    # Return non-translatable values as is
-    else:
-        return data
\ No newline at end of file
+
+async def prepare_json_translation(
+        data: Union[Dict, List, str, int, float, bool, None],
+        translator: Any,
+        target_lang: str,
+        source_lang: str = None
+) -> Tuple[List[Any], AsyncIterator[float]]:
+    """Plan the translation of values in JSON while preserving keys and structure.
+
+    All translatable strings are collected first and sent to DeepL in batches,
+    instead of one request per string. Size limits are checked here, before any
+    DeepL call. Returns a one-element list that will hold the translated JSON,
+    and an async iterator that runs the batches and yields the fraction done.
+    """
+
+    # Translations are written in place into a single deep copy of the input.
+    # Wrapping it in a list gives even a bare top-level string a parent.
+    root = [copy.deepcopy(data)]
+
+    collected = []
+    _collect(root, collected)
+
+    # Identical strings are translated once and fanned back out to every location
+    unique: Dict[str, List[tuple]] = {}
+    for parent, key, text in collected:
+        unique.setdefault(text, []).append((parent, key))
+
+    # Serve previously seen strings from the cache and only send misses to DeepL
+    texts = []
+    hits = await asyncio.to_thread(cache.get_many, unique, source_lang, target_lang)
+    for text, locations in unique.items():
+        cached = hits.get(text)
+        if cached is None:
+            texts.append(text)
+            continue
+        for parent, key in locations:
+            parent[key] = cached
+
+    batches = _batches(_measure(texts))
+
+    return root, _run_batches(batches, texts, unique, translator, target_lang, source_lang)
+
+
+async def _run_batches(
+        batches: List[List[int]],
+        texts: List[str],
+        unique: Dict[str, List[tuple]],
+        translator: Any,
+        target_lang: str,
+        source_lang: str = None
+) -> AsyncIterator[float]:
+    """Dispatch batches concurrently, bounded by DEEPL_MAX_CONCURRENCY.
+
+    Each finished batch is written into the JSON and the cache before the
+    fraction of completed batches is yielded. Closing the iterator early
+    cancels any batches still in flight.
+    """
+    semaphore = asyncio.Semaphore(DEEPL_MAX_CONCURRENCY)
+
+    async def run(batch: List[int]) -> Tuple[List[int], List[Any]]:
+        batch_texts = [texts[i] for i in batch]
+        return batch, await _translate_batch(semaphore, translator, batch_texts, target_lang, source_lang)
+
+    tasks = [asyncio.ensure_future(run(batch)) for batch in batches]
+    try:
+        for done, next_result in enumerate(asyncio.as_completed(tasks), start=1):
+            batch, translations = await next_result
+
+            translated = []
+            for i, translation in zip(batch, translations):
+                translated.append((texts[i], translation.text))
+                for parent, key in unique[texts[i]]:
+                    parent[key] = translation.text
+            await asyncio.to_thread(cache.put_many, translated, source_lang, target_lang)
+
+            yield done / len(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
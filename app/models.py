@@ -0,0 +1,19 @@
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class DocumentMetadata(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: str = Field(..., alias="@id")
+    object_name: str
+    object_hash: str
+    object_extension: str
+    object_size: int
+
+
+class TranslateDocumentRequest(BaseModel):
+    object_metadata: DocumentMetadata
+    target_lang: str
+    source_lang: Optional[str] = None
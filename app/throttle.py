@@ -0,0 +1,41 @@
+"""Client-side rate limiting for DeepL API calls."""
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst`.
+
+    Callers await acquire() and are released in arrival order once enough
+    tokens are available, so requests are spread out instead of being
+    rejected by the server.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst <= 0:
+            raise ValueError("Token bucket rate and burst must be positive")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, cost: float = 1) -> None:
+        """Wait until cost tokens are available and take them.
+
+        A call larger than the bucket only waits for a full bucket, then takes
+        its whole cost and leaves the bucket in debt, so later callers wait
+        long enough to keep the average at the configured rate.
+        """
+        needed = min(cost, self.burst)
+        async with self._lock:
+            self._refill()
+            while self._tokens < needed:
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= cost